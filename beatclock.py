@@ -2,58 +2,51 @@
 beatclock.py
 
 Responisble for MIDI communication with output device. Will send start and stop
-messages, as well as a beat clock signal.
+messages, as well as a beat clock signal. Pulses are timed from the same frame
+timeline as the steps of the pattern (see sequencer.py), using the position of
+the audio stream, so the device stays locked to the sampler's pattern instead
+of drifting with the difference between the sound card and the system clock.
 '''
 
-import time
 from mido import ports, messages
 
 PPQN = 24 # pulses per quarter note
-PPS = PPQN // 4 # pulses per step (16th note)
-MAX_STEPS = 16
 
 class BeatClock:
 
     clock_signal = messages.Message(type='clock')
     start_signal = messages.Message(type='start')
     stop_signal = messages.Message(type='stop')
-    sec_per_pulse: float
+    frames_per_pulse: float
     midiport: ports.BaseOutput
 
-    step: int = 0
-    pulse: int = 0
-    carry: float = 0.0
-    last_time: float = time.time()
+    # frame the clock was started on, and pulses sent since then
+    start_frame: int = 0
+    pulses: int = 0
     started: bool = False
 
-    def __init__(self, sec_per_pulse: float, midiport):
-        self.sec_per_pulse = sec_per_pulse
+    def __init__(self, frames_per_pulse: float, midiport):
+        self.frames_per_pulse = frames_per_pulse
         self.midiport = midiport
     
-    def start(self):
+    # start the clock on the given frame, which should be the frame the first
+    # step of the pattern starts on
+    def start(self, frame: int):
         self.started = True
-        self.step = 1 # Using 0 is an off-by-one error, but I can't tell why
-        self.pulse = 0
-        self.last_time = time.time()
+        self.start_frame = frame
+        self.pulses = 0
         self.midiport.send(self.start_signal)
 
     def stop(self):
         self.started = False
         self.midiport.send(self.stop_signal)
 
-    # update clock and return current step
-    def update(self) -> int:
-        curr_time = time.time()
-        elapsed = curr_time - self.last_time + self.carry
-        while elapsed >= self.sec_per_pulse:
-            elapsed -= self.sec_per_pulse
-            # only send out signal if we've been told to start
-            if self.started:
-                self.midiport.send(self.clock_signal)
-                self.pulse += 1
-                if self.pulse == PPS:
-                    self.pulse = 0
-                    self.step = (self.step + 1) % MAX_STEPS
-        self.carry = elapsed
-        self.last_time = curr_time
-        return self.step
+    # send any clock pulses that are due by the given frame
+    def update(self, frame: int):
+        # only send out signal if we've been told to start
+        if not self.started:
+            return
+        due = int((frame - self.start_frame) / self.frames_per_pulse)
+        while self.pulses < due:
+            self.midiport.send(self.clock_signal)
+            self.pulses += 1
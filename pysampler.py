@@ -9,17 +9,20 @@ functions in samplestream.py to play audio.
 import keyboard
 import json
 import mido
+from collections import deque
 from pyaudio import PyAudio
 from time import sleep
 from sys import argv
 
 import cliout
 from beatclock import BeatClock
-from samplestream import SampleStream
+from recorder import Recorder, SOURCE_TAP, SOURCE_PATTERN, SOURCE_FILL1, SOURCE_FILL2
+from sample import THRESHOLD
+from samplestream import SampleStream, RATE, BUFFER_FRAMES
+from sequencer import StepTiming, MAX_STEPS
 
 BACKEND = 'mido.backends.rtmidi'
 CONFIG: dict = json.loads(open('config.json', 'r').read())
-MAX_STEPS = 16
 BANK_SIZE = 8
 
 KEY_START = '='
@@ -67,14 +70,25 @@ class PySampler:
 
     stream: SampleStream
     clock: BeatClock
+    # only set if recording is enabled in the config
+    recorder: Recorder = None
 
     sec_per_pulse: float
     sleep_time: float
 
+    timing: StepTiming
+    # frame the current run through the pattern started on
+    loop_start: int
+    # steps are scheduled this many frames before they are due to play
+    lookahead: int
+
     step: int
     online: bool
     playing: bool
     muted: bool
+    # start, stop and shutdown keys pressed but not yet handled by run, which
+    # owns the step and loop position
+    transport_keys: deque[str]
 
     # handler function for keys with dynamic functions
     dynamic_key_handler = None
@@ -98,9 +112,19 @@ class PySampler:
     def __init__(self):
         self.online = True
         self.playing = False
+        self.transport_keys = deque()
         self.muted = False
         self.sec_per_pulse = (60 / CONFIG['bpm']) / 24
         self.sleep_time = self.sec_per_pulse / 2
+        # stream.frames only moves once per buffer, and by the time we wake up
+        # again the callback may have rendered every buffer that starts before
+        # then, so we have to look a buffer past our next wake up. Doubled to
+        # allow for late wake ups and buffers being requested in bursts.
+        self.lookahead = 2 * (BUFFER_FRAMES + int(RATE * self.sleep_time))
+        # "timing" is a list of up to 16 per step offsets, each a fraction of a
+        # step between -0.5 and 0.5, see sequencer.py
+        self.timing = StepTiming(CONFIG['bpm'], CONFIG.get('resolution', '16'),
+                CONFIG.get('swing', 0.5), CONFIG.get('timing'))
         self.dynamic_key_handler = self.kh_default
 
         self.midiport = None
@@ -130,9 +154,19 @@ class PySampler:
             print('\n' * 40, "Using audio device",
                     cliout.format_dev_name(self.audio.get_device_info_by_index(self.audiodev)))
 
-        self.stream = SampleStream(self.audio, self.audiodev)
-        self.clock = BeatClock(self.sec_per_pulse, self.midiport)
+        # "record": {"log": "session.pslog", "wav": "session.wav"}, where wav is
+        # optional
+        if CONFIG.get('record') is not None:
+            self.recorder = Recorder(CONFIG['record']['log'], CONFIG['record'].get('wav'))
+
+        # "trim": {"file.wav": {"start": 0, "end": 1000, "threshold": 32}}, or
+        # true/false to use or skip the detected trim points, see
+        # SampleStream.load
+        self.stream = SampleStream(self.audio, self.audiodev, self.recorder,
+                CONFIG.get('trim'), CONFIG.get('trim_threshold', THRESHOLD))
+        self.clock = BeatClock(RATE * self.sec_per_pulse, self.midiport)
         self.step = 0
+        self.loop_start = 0
 
         if CONFIG.get('pattern') is not None:
             ptn: str = CONFIG['pattern']
@@ -153,39 +187,59 @@ class PySampler:
             self.bank_index = 0
             self.load_bank()
 
+        self.load_samples()
+
     def run(self):
         self.online = True
         cliout.setup(self)
         keyboard.on_press(self.handle_key)
         while self.online:
-            step = self.clock.update()
-            while self.step != step:
+            while self.transport_keys:
+                self.handle_transport(self.transport_keys.popleft())
+            self.clock.update(self.stream.position())
+            # schedule every step due before the next time we wake up
+            horizon = self.stream.frames + self.lookahead
+            while self.playing and self.loop_start + self.timing.frames[self.step] < horizon:
                 self.play_step()
-                self.step = (self.step + 1) % MAX_STEPS
+                self.step += 1
+                if self.step == MAX_STEPS:
+                    self.step = 0
+                    self.loop_start += self.timing.loop_frames
             sleep(self.sleep_time)
         keyboard.unhook_all()
     
-    # handle keys with constant functions, pass others to dynamic key handler
-    def handle_key(self, event: keyboard.KeyboardEvent):
+    # handle start, stop and shutdown keys, called from run between steps
+    def handle_transport(self, key: str):
         # start key
-        if event.name == KEY_START:
+        if key == KEY_START:
+            self.stream.cancel_scheduled()
             self.step = 0
+            self.loop_start = self.stream.frames
             self.playing = True
-            self.clock.start()
+            self.clock.start(self.loop_start)
             cliout.update_top(self)
 
         # stop key
-        elif event.name == KEY_STOP:
+        elif key == KEY_STOP:
             self.playing = False
+            self.stream.cancel_scheduled()
             self.clock.stop()
             cliout.update_top(self)
 
         # shutdown key
-        elif event.name == KEY_SHUTDOWN:
+        elif key == KEY_SHUTDOWN:
             self.clock.stop()
             self.playing = False
+            self.stream.cancel_scheduled()
             self.online = False
 
+    # handle keys with constant functions, pass others to dynamic key handler
+    def handle_key(self, event: keyboard.KeyboardEvent):
+        # start, stop and shutdown keys are left to run, since it is moving
+        # through the pattern on another thread
+        if event.name in (KEY_START, KEY_STOP, KEY_SHUTDOWN):
+            self.transport_keys.append(event.name)
+
         # mute key
         elif event.name == KEY_MUTE:
             self.muted = not self.muted
@@ -225,7 +279,7 @@ class PySampler:
     def kh_default(self, event: str):
         # play tap sample
         if self.taps.get(event) is not None:
-            self.stream.play(self.taps[event])
+            self.stream.play(self.taps[event], SOURCE_TAP)
         # toggle fill 1
         elif event == KEY_FILL1:
             self.fill1_on = not self.fill1_on
@@ -301,17 +355,32 @@ class PySampler:
             self.pattern[KEY_TO_PAT_INDEX[event]] = None
             cliout.update_pattern(self)
 
+    # schedule the samples for the current step on the frame it is due
     def play_step(self):
+        frame = self.loop_start + self.timing.frames[self.step]
+
         if self.fill1_on and self.fill1 is not None \
                 and self.step % self.fill1[1] == 0:
-            self.stream.play(self.fill1[0])
+            self.stream.play(self.fill1[0], SOURCE_FILL1, self.step, frame)
         
         if self.fill2_on and self.fill2 is not None \
                 and self.step % self.fill2[1] == 0:
-            self.stream.play(self.fill2[0])
+            self.stream.play(self.fill2[0], SOURCE_FILL2, self.step, frame)
         
         if not self.muted and self.pattern[self.step] is not None:
-            self.stream.play(self.pattern[self.step])
+            self.stream.play(self.pattern[self.step], SOURCE_PATTERN, self.step, frame)
+
+    # load and trim every sample in the config before we start playing
+    def load_samples(self):
+        files = [x for x in self.pattern if x is not None]
+        if self.fill1 is not None:
+            files.append(self.fill1[0])
+        if self.fill2 is not None:
+            files.append(self.fill2[0])
+        for bank in self.tap_banks:
+            files.extend(bank)
+        for f in files:
+            self.stream.load(f)
 
     # load self.tap_banks[self.bank_index] into self.taps
     def load_bank(self):
@@ -337,14 +406,18 @@ class PySampler:
     def shut_down(self):
         self.midiport.close()
         self.audio.terminate()
+        if self.recorder is not None:
+            self.recorder.close()
         cliout.quit()
 
 if __name__ == "__main__":
     mido.set_backend(BACKEND)
     s = PySampler()
     
+    # shut down even on Ctrl+C, so the recording is written
     try:
         s.run()
     except Exception as e:
         print(e)
-    s.shut_down()
+    finally:
+        s.shut_down()
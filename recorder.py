@@ -0,0 +1,295 @@
+'''
+recorder.py
+
+Records a session so it can be listened to again later. Every sample triggered
+through SampleStream.play is appended to an event log as a fixed-size binary
+record holding the frame the sample started on, what triggered it (a tap, the
+pattern or one of the fills), the step and the sample. The trim points of each
+sample are logged too, so a session renders the same way it was heard even if
+the trim settings change. Records are packed into a preallocated buffer, so
+logging an event does not allocate anything unless the buffer is full or a
+sample is played for the first time. Samples are triggered from more than one
+thread, so the buffer is guarded by a lock.
+
+Full buffers are handed to a background thread which appends them to the log
+file, so a session is only lost back to the last full buffer if the program
+dies. The rest is written when the recorder is closed.
+
+The mixed output can also be written to a WAV file. Buffers from the audio
+callback are put on a bounded queue and written by another background thread.
+If the queue is full the buffer is dropped instead of waiting for the disk, and
+the writer fills the gap with silence so the file stays in time. If the WAV file
+can't be written, the writer gives up and the log is still recorded.
+
+A log can be rendered offline with:
+
+    python recorder.py <log file> <wav file>
+
+Log format (little-endian):
+    header: magic b'PSLG', version (u16), sample rate (u32)
+    then any number of chunks, one for each buffer written:
+    names:  count (u16) of samples first played in this chunk, then for each
+            name its length (u16) and utf-8 bytes, followed by the frames the
+            sample was trimmed to as a start and end (u32 each)
+    events: count (u32), then count records of EVENT
+'''
+
+import queue
+import struct
+import threading
+import wave
+from sys import argv
+
+from samplestream import SampleStream, BYTE_WIDTH, CHANNELS, RATE
+
+MAGIC = b'PSLG'
+VERSION = 1
+HEADER = struct.Struct('<4sHI')
+# frame (u64), source (u8), step (u8), sample name index (u16)
+EVENT = struct.Struct('<QBBH')
+# start and end frames of a trimmed sample (u32 each)
+TRIM = struct.Struct('<II')
+NO_STEP = 0xFF # step value for samples not triggered by the sequencer
+
+# what triggered a sample
+SOURCE_TAP = 0
+SOURCE_PATTERN = 1
+SOURCE_FILL1 = 2
+SOURCE_FILL2 = 3
+
+EVENT_CAPACITY = 256 # events buffered before they are written to the log
+QUEUE_SIZE = 64 # audio buffers waiting to be written to the WAV file
+CLOSE_TIMEOUT = 0.1 # seconds between checks on the WAV writer when closing
+RENDER_BLOCK = 1024 # frames rendered at a time when rendering a log
+
+class Recorder:
+
+    log_path: str
+    # packed EVENT records, only the first num_events are valid
+    events: bytearray
+    num_events: int
+    # (name, start, end) of each sample, an event stores the index of its sample
+    # in this list
+    names: list[tuple[str, int, int]]
+    name_index: dict[str, int]
+    # names added since the last chunk was written
+    new_names: list[tuple[str, int, int]]
+    # guards everything above, record is called from several threads
+    lock: threading.Lock
+    # chunks waiting to be appended to the log, None stops the log writer
+    log_queue: queue.Queue
+    log_writer: threading.Thread
+    # set if the log or WAV file couldn't be written
+    log_error: Exception
+    wav_error: Exception
+
+    wav_path: str
+    audio_queue: queue.Queue
+    writer: threading.Thread
+    # frames dropped since the last buffer that made it onto the queue
+    dropped: int
+
+    def __init__(self, log_path: str, wav_path: str = None):
+        self.log_path = log_path
+        self.events = bytearray(EVENT.size * EVENT_CAPACITY)
+        self.num_events = 0
+        self.names = []
+        self.name_index = dict()
+        self.new_names = []
+        self.lock = threading.Lock()
+        self.log_error = None
+        self.wav_error = None
+
+        # open the log now so a bad path is reported before anything is played
+        log_file = open(log_path, 'wb')
+        log_file.write(HEADER.pack(MAGIC, VERSION, RATE))
+        self.log_queue = queue.Queue()
+        self.log_writer = threading.Thread(target=self.write_log, args=(log_file,), daemon=True)
+        self.log_writer.start()
+
+        self.wav_path = wav_path
+        self.audio_queue = None
+        self.writer = None
+        self.dropped = 0
+        if wav_path is not None:
+            self.audio_queue = queue.Queue(QUEUE_SIZE)
+            self.writer = threading.Thread(target=self.write_wav, daemon=True)
+            self.writer.start()
+
+    # append an event to the log. trim is the (start, end) frames the sample was
+    # trimmed to, only used the first time the sample is recorded
+    def record(self, frame: int, source: int, step: int, filename: str,
+            trim: tuple[int, int]):
+        if step < 0:
+            step = NO_STEP
+        with self.lock:
+            index = self.name_index.get(filename)
+            if index is None:
+                index = len(self.names)
+                self.names.append((filename, trim[0], trim[1]))
+                self.name_index[filename] = index
+                self.new_names.append(self.names[index])
+
+            EVENT.pack_into(self.events, self.num_events * EVENT.size, frame, source, step, index)
+            self.num_events += 1
+            if self.num_events == EVENT_CAPACITY:
+                self.flush()
+
+    # hand the buffered events to the log writer and start a new buffer, must be
+    # called with self.lock held
+    def flush(self):
+        self.log_queue.put((self.new_names, self.events, self.num_events))
+        self.new_names = []
+        self.events = bytearray(EVENT.size * EVENT_CAPACITY)
+        self.num_events = 0
+
+    # body of the log writer thread, stops when it gets None from the queue
+    def write_log(self, f):
+        with f:
+            while True:
+                item = self.log_queue.get()
+                if item is None:
+                    break
+                if self.log_error is not None:
+                    continue
+                names, events, num_events = item
+                try:
+                    f.write(struct.pack('<H', len(names)))
+                    for name, start, end in names:
+                        encoded = name.encode('utf-8')
+                        f.write(struct.pack('<H', len(encoded)))
+                        f.write(encoded)
+                        f.write(TRIM.pack(start, end))
+                    f.write(struct.pack('<I', num_events))
+                    f.write(events[:num_events * EVENT.size])
+                    f.flush()
+                except (OSError, struct.error) as e:
+                    # keep draining the queue so close doesn't wait forever
+                    self.log_error = e
+
+    # called from the audio callback, must never block
+    def write_audio(self, data: bytes):
+        if self.audio_queue is None:
+            return
+        try:
+            self.audio_queue.put_nowait((self.dropped, data))
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += len(data) // (BYTE_WIDTH * CHANNELS)
+
+    # body of the WAV writer thread, stops when it gets None from the queue or
+    # the file can't be written
+    def write_wav(self):
+        try:
+            # opening the file first keeps wave from complaining if it fails
+            f = open(self.wav_path, 'wb')
+            with f, wave.open(f, 'wb') as out:
+                out.setnchannels(CHANNELS)
+                out.setsampwidth(BYTE_WIDTH)
+                out.setframerate(RATE)
+                while True:
+                    item = self.audio_queue.get()
+                    if item is None:
+                        break
+                    dropped, data = item
+                    if dropped > 0:
+                        out.writeframes(bytes(dropped * BYTE_WIDTH * CHANNELS))
+                    out.writeframes(data)
+        except (OSError, wave.Error) as e:
+            self.wav_error = e
+
+    # write the rest of the event log, then stop the WAV writer
+    def close(self):
+        with self.lock:
+            if self.num_events > 0 or self.new_names:
+                self.flush()
+        self.log_queue.put(None)
+        self.log_writer.join()
+
+        if self.writer is not None:
+            # the writer may have died with the queue full, so don't wait on it
+            while self.writer.is_alive():
+                try:
+                    self.audio_queue.put(None, timeout=CLOSE_TIMEOUT)
+                    break
+                except queue.Full:
+                    pass
+            self.writer.join()
+            self.writer = None
+
+        if self.log_error is not None:
+            print(f"Error: could not write event log {self.log_path}: {self.log_error}")
+        if self.wav_error is not None:
+            print(f"Error: could not write {self.wav_path}: {self.wav_error}")
+
+# read a log written by a Recorder, returns a list of (name, start, end) for
+# each sample and a list of (frame, source, step, name index) tuples
+def read_log(path: str) -> tuple[list[tuple[str, int, int]], list[tuple[int, int, int, int]]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, rate = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise Exception(f'{path} is not a pysampler event log')
+    if rate != RATE:
+        raise Exception(f'{path} was recorded at {rate} Hz, expected {RATE} Hz')
+    pos = HEADER.size
+
+    names = []
+    events = []
+    # a chunk cut short by the program dying is ignored
+    try:
+        while pos < len(data):
+            (num_names,) = struct.unpack_from('<H', data, pos)
+            pos += 2
+            chunk_names = []
+            for _ in range(num_names):
+                (length,) = struct.unpack_from('<H', data, pos)
+                pos += 2
+                name = data[pos : pos + length].decode('utf-8')
+                pos += length
+                start, end = TRIM.unpack_from(data, pos)
+                pos += TRIM.size
+                chunk_names.append((name, start, end))
+
+            (num_events,) = struct.unpack_from('<I', data, pos)
+            pos += 4
+            chunk = data[pos : pos + num_events * EVENT.size]
+            if len(chunk) < num_events * EVENT.size:
+                break
+            names.extend(chunk_names)
+            events.extend(EVENT.iter_unpack(chunk))
+            pos += num_events * EVENT.size
+    except (struct.error, UnicodeDecodeError):
+        pass
+    return names, events
+
+# render the session in a log to a WAV file, starting each sample on the frame
+# it was recorded on
+def render_log(log_path: str, wav_path: str):
+    names, events = read_log(log_path)
+    # trim samples the way they were trimmed when they were recorded
+    trims = {name: {'start': start, 'end': end} for name, start, end in names}
+    stream = SampleStream(None, None, trims=trims)
+
+    out = wave.open(wav_path, 'wb')
+    out.setnchannels(CHANNELS)
+    out.setsampwidth(BYTE_WIDTH)
+    out.setframerate(RATE)
+
+    # taps and steps are logged from different threads, so the log may be
+    # slightly out of order
+    for frame, _, _, index in sorted(events, key=lambda e: e[0]):
+        stream.play(names[index][0], at=frame)
+
+    # render until every sample has finished
+    while stream.scheduled or stream.queued_samples \
+            or any(w.tell() < w.getnframes() for w in stream.samples):
+        out.writeframes(stream.render(RENDER_BLOCK))
+    out.close()
+
+if __name__ == "__main__":
+    if len(argv) != 3:
+        print("Usage: python recorder.py <log file> <wav file>")
+        exit()
+    render_log(argv[1], argv[2])
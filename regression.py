@@ -0,0 +1,475 @@
+'''
+regression.py
+
+Checks that the mixer and step logic still behave the way they always have, so
+faster versions of SampleStream.render or PySampler.play_step can be swapped in
+with confidence. Nothing here needs an audio or MIDI device.
+
+The reference mixer is BaselineStream, the original pure-Python SampleStream
+with the device left out. The mixer is checked against it on randomized
+scenarios of overlapping and retriggered samples with random buffer sizes, both
+untrimmed and trimmed as config.json says. golden.json holds hashes of the
+baseline's renders of every untrimmed file in samples/ and of a fixed mix, which
+the current mixer must match. Samples are checked to be trimmed as config.json
+says and sessions to re-render from their logs exactly as they were played.
+Step logic is checked against a reference for every fill frequency key (0
+meaning every 16 steps), the pattern and muting, and the step timing tables for
+every resolution.
+
+    python regression.py            run every check
+    python regression.py bench      also time the mixer
+    python regression.py golden     rewrite golden.json from BaselineStream
+
+Run it from the directory with config.json, like pysampler.py.
+'''
+
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import wave
+from array import array
+from sys import argv
+
+from recorder import Recorder, render_log, QUEUE_SIZE, SOURCE_PATTERN, SOURCE_FILL1, SOURCE_FILL2
+from sample import find_trim, THRESHOLD
+from samplestream import SampleStream, CHANNELS, FRAME_WIDTH, RATE, MAX, MIN, BUFFER_FRAMES
+from sequencer import StepTiming, RESOLUTIONS, MAX_STEPS, MIN_SWING, MAX_SWING
+
+GOLDEN_FILE = 'golden.json'
+SEED = 0
+MIX_SCENARIOS = 50
+STEP_LOOPS = 1000
+TRIM_CASES = 500
+BENCH_VOICES = (1, 4, 8)
+BENCH_BLOCK = 1024
+BENCH_BLOCKS = 50
+
+RECORDER_SCENARIOS = 10
+GOLDEN_MIX_SPACING = 3 # buffers between samples in the golden mix
+
+CONFIG: dict = json.loads(open('config.json', 'r').read())
+
+SAMPLE_FILES = sorted(f[len('samples/'):] for f in glob.glob('samples/*/*.wav'))
+
+# The original SampleStream, kept as the reference mixer. Only the pyaudio stream
+# is left out, frames are pulled with render. open_sample opens a file by name,
+# by default as a wave.Wave_read of the whole file as the original did.
+class BaselineStream:
+
+    # samples currently playing
+    samples: set
+    # samples we need to add to samples
+    queued_samples: set
+    # map filenames to the associated sample
+    samp_files: dict
+
+    def __init__(self, open_sample=None):
+        self.samples = set()
+        self.queued_samples = set()
+        self.samp_files = dict()
+        self.open_sample = open_sample
+        if open_sample is None:
+            self.open_sample = lambda filename: wave.open('samples/' + filename, 'rb')
+
+    # add the given file to the samples being played in the callback function
+    def play(self, filename):
+        # if it's already open, rewind it
+        sf = self.samp_files.get(filename)
+        if sf is not None:
+            sf.rewind()
+        # if it hasn't been opened, open it and add to queue
+        else:
+            sf = self.open_sample(filename)
+            self.samp_files[filename] = sf
+            self.queued_samples.add(sf)
+
+    # the original callback, returning only the frames
+    def render(self, frame_count: int) -> bytes:
+        # add any queued samples
+        self.samples.update(self.queued_samples)
+        self.queued_samples.clear()
+
+        # at most frame_count frames from each wave will be converted to ints
+        buffs: list[array] = []
+        # final result
+        result = array('h', b'\0' * frame_count * FRAME_WIDTH)
+        # intermediate result
+        temp = [0] * frame_count * CHANNELS
+
+        # read frame_count frames from each sample, convert to 16-bit ints
+        num_buffs = 0 # count number of buffers
+        for wave in self.samples:
+            # read frames
+            wbytes = wave.readframes(frame_count)
+
+            # if we've read all frames, don't include in buffs
+            if len(wbytes) == 0:
+                continue
+
+            # convert to array of 16-bit signed integers
+            buffs.append(array('h', wbytes))
+            num_buffs += 1
+
+        # add contents of all samples into temp
+        for i in range(num_buffs):
+            curr = buffs[i]
+            for j in range(len(curr)):
+                temp[j] += curr[j]
+        
+        # copy temp into result, clamp to signed 16-bit limits
+        for i in range(len(temp)):
+            if temp[i] > MAX:
+                result[i] = MAX
+            elif temp[i] < MIN:
+                result[i] = MIN
+            else:
+                result[i] = temp[i]
+        
+        # convert buffer back into bytes and return it
+        return result.tobytes()
+
+# render events with BaselineStream. It can only start samples at the start of
+# a buffer, so buffers are split on every event.
+def baseline_mix(stream: BaselineStream, events: list[tuple[int, str]], length: int) -> bytes:
+    out = []
+    pos = 0
+    for frame, filename in events + [(length, None)]:
+        while pos < frame:
+            frame_count = min(BUFFER_FRAMES, frame - pos)
+            out.append(stream.render(frame_count))
+            pos += frame_count
+        if filename is not None:
+            stream.play(filename)
+    return b''.join(out)
+
+# render events with SampleStream in buffers of random size, playing some of
+# them unscheduled at the start of a buffer and scheduling the rest
+def stream_mix(stream: SampleStream, events: list[tuple[int, str]], length: int,
+        rng: random.Random) -> bytes:
+    out = []
+    i = 0
+    while stream.frames < length:
+        while i < len(events) and events[i][0] == stream.frames and rng.random() < 0.5:
+            stream.play(events[i][1])
+            i += 1
+        frame_count = min(rng.randint(1, 2048), length - stream.frames)
+        # schedule everything due in this buffer
+        while i < len(events) and events[i][0] < stream.frames + frame_count:
+            stream.play(events[i][1], at=events[i][0])
+            i += 1
+        out.append(stream.render(frame_count))
+    return b''.join(out)
+
+# random events on a few files, often overlapping and retriggering each other
+def random_events(rng: random.Random, length: int) -> list[tuple[int, str]]:
+    files = rng.sample(SAMPLE_FILES, rng.randint(1, 6))
+    events = [(rng.randrange(length), rng.choice(files)) for _ in range(rng.randint(1, 24))]
+    # retrigger on the same frame as another event now and then
+    if rng.random() < 0.3:
+        events.append((events[0][0], rng.choice(files)))
+    events.sort(key=lambda e: e[0])
+    return events
+
+# even scenarios are untrimmed, odd ones are trimmed as config.json says
+def check_mixer():
+    rng = random.Random(SEED)
+    for n in range(MIX_SCENARIOS):
+        length = rng.randint(1, RATE)
+        events = random_events(rng, length)
+        if n % 2 == 0:
+            stream = untrimmed_stream()
+            baseline = BaselineStream()
+        else:
+            stream = config_stream()
+            # the baseline gets its own copies of the samples
+            baseline = BaselineStream(config_stream().load)
+        expected = baseline_mix(baseline, events, length)
+        actual = stream_mix(stream, events, length, rng)
+        assert actual == expected, f'mixer scenario {n} differs from baseline: {events}'
+
+# an offline stream trimming samples the way config.json says to
+def config_stream(recorder: Recorder = None) -> SampleStream:
+    return SampleStream(None, None, recorder, CONFIG.get('trim'),
+            CONFIG.get('trim_threshold', THRESHOLD))
+
+# an offline stream playing every sample untrimmed, like the original
+def untrimmed_stream() -> SampleStream:
+    return SampleStream(None, None, trims={f: False for f in SAMPLE_FILES})
+
+# the samples loaded with the trims in config.json are the frames they should be
+# trimmed to, worked out one sample at a time
+def check_config_trims():
+    trims: dict = CONFIG.get('trim', dict())
+    threshold = CONFIG.get('trim_threshold', THRESHOLD)
+    stream = config_stream()
+    for f in SAMPLE_FILES:
+        with wave.open('samples/' + f, 'rb') as wf:
+            channels = wf.getnchannels()
+            width = wf.getsampwidth() * channels
+            raw = wf.readframes(wf.getnframes())
+        trim = trims.get(f, True)
+        if trim is False:
+            expected = raw
+        else:
+            if trim is True:
+                trim = dict()
+            data = array('h', raw)
+            loud = [i for i in range(len(data)) if abs(data[i]) > trim.get('threshold', threshold)]
+            start = trim.get('start', loud[0] // channels if loud else 0)
+            end = trim.get('end', loud[-1] // channels + 1 if loud else 0)
+            expected = raw[start * width : max(start, end) * width]
+        assert stream.load(f).data == expected, f'{f} is not trimmed as configured'
+
+    # overrides outside the file are clamped to it, anything but whole frames
+    # is refused
+    f = SAMPLE_FILES[0]
+    with wave.open('samples/' + f, 'rb') as wf:
+        nframes = wf.getnframes()
+    stream = SampleStream(None, None, trims={f: {'start': -100, 'end': nframes + 100}})
+    sf = stream.load(f)
+    assert (sf.start, sf.end) == (0, nframes), f'trim of {f} is not clamped to the file'
+    for bad in (1.5, '10', True):
+        stream = SampleStream(None, None, trims={f: {'start': bad}})
+        try:
+            stream.load(f)
+        except Exception as e:
+            assert 'whole number' in str(e), f'unexpected error for trim start {bad!r}: {e}'
+        else:
+            assert False, f'trim start {bad!r} was accepted'
+
+# a session re-rendered from its log is the same as it was live
+def check_recorder():
+    rng = random.Random(SEED)
+    with tempfile.TemporaryDirectory() as tmp:
+        log_path = os.path.join(tmp, 'session.pslog')
+        live_path = os.path.join(tmp, 'live.wav')
+        render_path = os.path.join(tmp, 'render.wav')
+        for n in range(RECORDER_SCENARIOS):
+            length = rng.randint(1, RATE)
+            events = random_events(rng, length)
+            recorder = Recorder(log_path, live_path)
+            stream = config_stream(recorder)
+            live = stream_mix(stream, events, length, rng)
+            for data in (live[i : i + 4096] for i in range(0, len(live), 4096)):
+                recorder.write_audio(data)
+            recorder.close()
+
+            # the queue never fills here, so every buffer is written
+            with wave.open(live_path, 'rb') as wf:
+                assert wf.readframes(wf.getnframes()) == live, \
+                        f'recorder scenario {n} wrote a different WAV file: {events}'
+
+            render_log(log_path, render_path)
+            with wave.open(render_path, 'rb') as wf:
+                rendered = wf.readframes(wf.getnframes())
+            # the render plays every sample to the end, past where live stopped
+            assert rendered[:len(live)] == live, f'recorder scenario {n} renders differently: {events}'
+
+        # buffers dropped while the queue is full are written as silence. The
+        # writer is only started once the queue is full, so the drops are certain
+        recorder = Recorder(log_path)
+        recorder.wav_path = live_path
+        recorder.audio_queue = queue.Queue(QUEUE_SIZE)
+        buffers = [rng.randbytes(rng.randint(1, BUFFER_FRAMES) * FRAME_WIDTH)
+                for _ in range(QUEUE_SIZE + 5)]
+        for data in buffers:
+            recorder.write_audio(data)
+        recorder.writer = threading.Thread(target=recorder.write_wav, daemon=True)
+        recorder.writer.start()
+        while recorder.audio_queue.full():
+            time.sleep(0.001)
+        last = rng.randbytes(BUFFER_FRAMES * FRAME_WIDTH)
+        recorder.write_audio(last)
+        recorder.close()
+
+        dropped = sum(len(data) for data in buffers[QUEUE_SIZE:])
+        expected = b''.join(buffers[:QUEUE_SIZE]) + bytes(dropped) + last
+        with wave.open(live_path, 'rb') as wf:
+            assert wf.readframes(wf.getnframes()) == expected, \
+                    'dropped buffers are not filled with the right amount of silence'
+
+# hashes of every untrimmed sample on its own, and of all of them started a few
+# buffers apart, rendered by the stream new_stream returns
+def golden_renders(new_stream) -> dict[str, str]:
+    renders = dict()
+    lengths = dict()
+    for f in SAMPLE_FILES:
+        with wave.open('samples/' + f, 'rb') as wf:
+            lengths[f] = wf.getnframes()
+
+    for name in SAMPLE_FILES + ['mix']:
+        stream = new_stream()
+        if name == 'mix':
+            starts = [(i * GOLDEN_MIX_SPACING, f) for i, f in enumerate(SAMPLE_FILES)]
+            num_buffers = max(s + -(-lengths[f] // BUFFER_FRAMES) for s, f in starts)
+        else:
+            starts = [(0, name)]
+            num_buffers = -(-lengths[name] // BUFFER_FRAMES)
+
+        out = []
+        for i in range(num_buffers):
+            for s, f in starts:
+                if s == i:
+                    stream.play(f)
+            out.append(stream.render(BUFFER_FRAMES))
+        renders[name] = hashlib.sha256(b''.join(out)).hexdigest()
+    return renders
+
+def check_golden():
+    with open(GOLDEN_FILE, 'r') as f:
+        golden: dict[str, str] = json.loads(f.read())
+    renders = golden_renders(untrimmed_stream)
+    assert renders.keys() == golden.keys(), f'{GOLDEN_FILE} does not match the files in samples/'
+    for name, digest in renders.items():
+        assert golden[name] == digest, f'render of {name} differs from {GOLDEN_FILE}'
+
+# samples which should be played on a step, as (source, filename) pairs. keys
+# are the number keys used to pick each fill's frequency
+def reference_step(step: int, pattern: list[str], fills: list[str], keys: list[int],
+        fills_on: list[bool], muted: bool) -> list[tuple[int, str]]:
+    plays = []
+    for fill, key, on, source in zip(fills, keys, fills_on, (SOURCE_FILL1, SOURCE_FILL2)):
+        # 0 -> the first step only, n -> every n steps from the first step, with
+        # the count starting over on every run through the pattern
+        if on and step in range(0, MAX_STEPS, MAX_STEPS if key == 0 else key):
+            plays.append((source, fill))
+    if not muted and pattern[step] is not None:
+        plays.append((SOURCE_PATTERN, pattern[step]))
+    return plays
+
+# stands in for SampleStream, keeping track of what was played
+class PlayLog:
+
+    plays: list[tuple[int, str, int, int]]
+
+    def __init__(self):
+        self.plays = []
+
+    def play(self, filename, source: int = 0, step: int = -1, at: int = None):
+        self.plays.append((source, filename, step, at))
+
+def check_steps():
+    rng = random.Random(SEED)
+    # needs keyboard and mido, but never touches a device. cliout has to be
+    # imported first, since it imports pysampler and pysampler imports it
+    import cliout
+    from pysampler import PySampler, KEY_FILL1, KEY_FILL2
+
+    for n in range(STEP_LOOPS):
+        sampler = PySampler.__new__(PySampler)
+        sampler.stream = PlayLog()
+        sampler.timing = StepTiming(rng.randint(60, 200), rng.choice(list(RESOLUTIONS)))
+        sampler.loop_start = rng.randrange(RATE * 60)
+        sampler.pattern = [rng.choice((None, rng.choice(SAMPLE_FILES))) for _ in range(MAX_STEPS)]
+        sampler.fill1 = (rng.choice(SAMPLE_FILES), 1)
+        sampler.fill2 = (rng.choice(SAMPLE_FILES), 1)
+        sampler.muted = rng.random() < 0.3
+
+        # pick frequencies the way a user would, with the number keys
+        keys = (rng.randrange(10), rng.randrange(10))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for slot, key in zip((KEY_FILL1, KEY_FILL2), keys):
+                sampler.next_fill = sampler.fill1[0] if slot == KEY_FILL1 else sampler.fill2[0]
+                sampler.kh_overwrite_fill(slot)
+                sampler.kh_fill_freq(str(key))
+        for key, fill in zip(keys, (sampler.fill1, sampler.fill2)):
+            assert fill[1] == (16 if key == 0 else key), f'key {key} set frequency {fill[1]}'
+
+        for step in range(MAX_STEPS):
+            sampler.fill1_on = rng.random() < 0.8
+            sampler.fill2_on = rng.random() < 0.8
+            sampler.step = step
+            sampler.stream.plays.clear()
+            sampler.play_step()
+
+            frame = sampler.loop_start + sampler.timing.frames[step]
+            expected = [(source, filename, step, frame) for source, filename in
+                    reference_step(step, sampler.pattern, [sampler.fill1[0], sampler.fill2[0]],
+                    keys, [sampler.fill1_on, sampler.fill2_on], sampler.muted)]
+            assert sampler.stream.plays == expected, \
+                    f'step {step} of loop {n} played {sampler.stream.plays}, expected {expected}'
+
+def check_timing():
+    rng = random.Random(SEED)
+    for resolution, per_quarter in RESOLUTIONS.items():
+        bpm = rng.uniform(60, 200)
+        step_len = RATE * 60 / bpm / per_quarter
+
+        # straight timing is evenly spaced
+        timing = StepTiming(bpm, resolution)
+        assert timing.frames == [round(i * step_len) for i in range(MAX_STEPS)], \
+                f'straight {resolution} steps are not evenly spaced'
+        assert timing.loop_frames == round(MAX_STEPS * step_len)
+
+        # swing pushes back the odd steps and offsets move steps by a fraction of
+        # a step. Offsets within a quarter step can't push a step past the next
+        # one even at full swing, so nothing is clamped
+        swing = rng.uniform(MIN_SWING, MAX_SWING)
+        offsets = [rng.uniform(-0.25, 0.25) for _ in range(MAX_STEPS)]
+        timing = StepTiming(bpm, resolution, swing, offsets)
+        for i in range(MAX_STEPS):
+            expected = round((i + offsets[i] + (2 * swing - 1 if i % 2 == 1 else 0)) * step_len)
+            assert timing.frames[i] == expected, \
+                    f'{resolution} step {i} is on frame {timing.frames[i]}, expected {expected}'
+
+        # anything else stays in order
+        offsets = [rng.uniform(-1, 1) for _ in range(MAX_STEPS)]
+        timing = StepTiming(bpm, resolution, rng.uniform(MIN_SWING, MAX_SWING), offsets)
+        for i in range(1, MAX_STEPS):
+            assert timing.frames[i - 1] <= timing.frames[i] <= timing.loop_frames + timing.frames[0], \
+                    f'{resolution} step {i} is out of order'
+
+def check_trim():
+    rng = random.Random(SEED)
+    for n in range(TRIM_CASES):
+        channels = rng.randint(1, 2)
+        num = rng.randint(0, 2000) * channels
+        samples = array('h', [0] * num)
+        for _ in range(rng.randint(0, 4)):
+            if num > 0:
+                samples[rng.randrange(num)] = rng.randint(MIN, MAX)
+
+        # first and last loud sample, one at a time
+        loud = [i for i in range(num) if abs(samples[i]) > THRESHOLD]
+        expected = (loud[0] // channels, loud[-1] // channels + 1) if loud else (0, 0)
+        actual = find_trim(samples, channels, THRESHOLD)
+        assert actual == expected, f'trim case {n} found {actual}, expected {expected}'
+
+def bench():
+    rng = random.Random(SEED)
+    for voices in BENCH_VOICES:
+        stream = SampleStream(None, None)
+        files = rng.sample(SAMPLE_FILES, voices)
+        start = time.perf_counter()
+        for _ in range(BENCH_BLOCKS):
+            for f in files:
+                stream.play(f)
+            stream.render(BENCH_BLOCK)
+        elapsed = (time.perf_counter() - start) / BENCH_BLOCKS
+        budget = BENCH_BLOCK / RATE
+        print(f'{voices} voices: {elapsed * 1000:.2f} ms per {BENCH_BLOCK} frames '
+                f'({elapsed / budget:.0%} of real time)')
+
+if __name__ == "__main__":
+    if 'golden' in argv:
+        with open(GOLDEN_FILE, 'w') as f:
+            f.write(json.dumps(golden_renders(BaselineStream), indent=4) + '\n')
+        print(f'Wrote {GOLDEN_FILE}')
+        exit()
+
+    checks = (check_trim, check_config_trims, check_timing, check_mixer, check_recorder,
+            check_golden, check_steps)
+    for check in checks:
+        check()
+        print(f'{check.__name__}: ok')
+
+    if 'bench' in argv:
+        bench()
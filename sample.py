@@ -0,0 +1,102 @@
+'''
+sample.py
+
+Loads sample files into memory and trims them to the part worth playing. When a
+file is loaded, the leading silence before its onset and the tail of near-zero
+frames at its end are found and cut off, so the mixer doesn't spend time adding
+silence and a pad hit is heard as soon as it starts playing.
+
+The onset is the first frame with any channel louder than the threshold, and the
+tail starts after the last such frame. Both are found by checking WINDOW frames
+at a time with max and min, which run in C over the whole window, then checking
+the frames of the first (or last) loud window one at a time.
+
+A Sample can be used in place of a wave.Wave_read by SampleStream.
+'''
+
+import wave
+from array import array
+
+THRESHOLD = 32 # samples this close to zero count as silence (about -60 dBFS)
+WINDOW = 256 # frames checked at a time when looking for the onset and tail
+
+class Sample:
+
+    # trimmed frames
+    data: bytes
+    frame_width: int
+    # frames trimmed from the start of the file, and where the trim ends
+    start: int
+    end: int
+    # read position in data, in bytes
+    pos: int
+
+    # load the file at path. start and end override the detected trim points,
+    # given in frames of the original file and clamped to the file
+    def __init__(self, path: str, start: int = None, end: int = None,
+            threshold: int = THRESHOLD):
+        with wave.open(path, 'rb') as wf:
+            channels = wf.getnchannels()
+            self.frame_width = wf.getsampwidth() * channels
+            nframes = wf.getnframes()
+            raw = wf.readframes(nframes)
+
+        if start is None or end is None:
+            onset, tail = find_trim(array('h', raw), channels, threshold)
+            if start is None:
+                start = onset
+            if end is None:
+                end = tail
+        self.start = min(max(start, 0), nframes)
+        self.end = min(max(self.start, end), nframes)
+
+        self.data = raw[self.start * self.frame_width : self.end * self.frame_width]
+        self.pos = 0
+
+    def rewind(self):
+        self.pos = 0
+
+    # return up to n frames as bytes, or an empty bytes object once finished
+    def readframes(self, n: int) -> bytes:
+        frames = self.data[self.pos : self.pos + n * self.frame_width]
+        self.pos += len(frames)
+        return frames
+
+    def tell(self) -> int:
+        return self.pos // self.frame_width
+
+    def getnframes(self) -> int:
+        return len(self.data) // self.frame_width
+
+# return the first frame louder than threshold and the frame after the last one,
+# (0, 0) if every frame is quieter than threshold
+def find_trim(samples: array, channels: int, threshold: int) -> tuple[int, int]:
+    num_samples = len(samples)
+    window = WINDOW * channels
+
+    # find the first window with a loud sample, then the first loud sample in it
+    onset = num_samples
+    for i in range(0, num_samples, window):
+        chunk = samples[i : i + window]
+        if max(chunk) > threshold or min(chunk) < -threshold:
+            for j in range(len(chunk)):
+                if abs(chunk[j]) > threshold:
+                    onset = i + j
+                    break
+            break
+    if onset == num_samples:
+        return (0, 0)
+
+    # same again from the end, the onset is known to be loud so we stop there
+    tail = onset
+    for i in range(num_samples, onset, -window):
+        lo = max(i - window, onset)
+        chunk = samples[lo : i]
+        if max(chunk) > threshold or min(chunk) < -threshold:
+            for j in range(len(chunk) - 1, -1, -1):
+                if abs(chunk[j]) > threshold:
+                    tail = lo + j
+                    break
+            break
+
+    return (onset // channels, tail // channels + 1)
@@ -3,60 +3,140 @@ samplestream.py
 
 This class is responsible for the audio output of the program. It opens a
 pyaudio Stream for sending waveform data to a given output device. It keeps one
-Wave_read object for each file that the user can play. When its play function is
-called, it will rewind the Wave_read associated with the filename passed to the
-function.
+Sample object for each file that the user can play, loaded into memory and
+trimmed as described in sample.py. When its play function is called, it will
+rewind the Sample associated with the filename passed to the function.
 
 See this class' callback function for documentation on how sample waveforms are
 combined and sent to the output device.
+
+If a Recorder is attached, every sample is logged with the frame it starts on.
+Both unscheduled and scheduled samples are logged by the callback when it
+starts them, so steps cancelled before they start are never logged. Every
+buffer sent to the output device is handed to the recorder so it can be written
+to a WAV file.
+
+Samples can also be scheduled to start on a given frame, which is how the
+sequencer plays steps. The callback splits its buffer at each scheduled start
+that falls inside it, so steps start on exactly the frame they were given.
 '''
 
-import wave
+import threading
+import time
 from array import array
+from collections import deque
 from pyaudio import PyAudio, Stream, paContinue
 
+from sample import Sample, THRESHOLD
+
 BYTE_WIDTH = 2 # PCM 16 format
 CHANNELS = 2 # stereo
 FRAME_WIDTH = BYTE_WIDTH * CHANNELS
 RATE = 44100 # sample rate, Hz
+BUFFER_FRAMES = 1024 # frames requested by each callback
 MAX = 2**15 - 1
 MIN = -2**15
 
 class SampleStream:
 
     stream: Stream
-    # wave files currently playing
-    samples: set[wave.Wave_read]
-    # wave files we need to add to samples
-    queued_samples: set[wave.Wave_read]
-    # map filenames to the associated wave
-    samp_files: dict[str, wave.Wave_read]
-
-    # initialize stream connected to device
-    def __init__(self, audio: PyAudio, device: int):
-        self.stream = audio.open(
-            format=audio.get_format_from_width(BYTE_WIDTH),
-            channels=CHANNELS,
-            rate=RATE,
-            output=True,
-            start=True,
-            output_device_index=device,
-            stream_callback=self.callback)
+    # samples currently playing
+    samples: set[Sample]
+    # samples to start at the beginning of the next buffer, along with the
+    # filename, source and step to log when they start
+    queued_samples: deque[tuple[Sample, str, int, int]]
+    # map filenames to the associated sample
+    samp_files: dict[str, Sample]
+    # samples to start on a given frame, in order of frame, along with the
+    # filename, source and step to log when they start
+    scheduled: deque[tuple[int, Sample, str, int, int]]
+    # guards taking from scheduled against clearing it
+    schedule_lock: threading.Lock
+    # map filenames to trim settings overriding the detected ones, see load
+    trims: dict[str, dict]
+    threshold: int
+    # number of frames rendered so far
+    frames: int
+    # frames rendered and the time when the last buffer was requested, as one
+    # tuple so it can be read from another thread
+    frames_time: tuple[int, float]
+    # optional event log and WAV writer, see recorder.py
+    recorder = None
+
+    # initialize stream connected to device, or an offline stream if audio is
+    # None, in which case frames must be pulled with render
+    def __init__(self, audio: PyAudio, device: int, recorder=None,
+            trims: dict[str, dict] = None, threshold: int = THRESHOLD):
         self.samples = set()
-        self.queued_samples = set()
+        self.queued_samples = deque()
         self.samp_files = dict()
+        self.scheduled = deque()
+        self.schedule_lock = threading.Lock()
+        self.trims = trims if trims is not None else dict()
+        self.threshold = threshold
+        self.frames = 0
+        self.frames_time = (0, time.time())
+        self.recorder = recorder
+        self.stream = None
+        if audio is not None:
+            self.stream = audio.open(
+                format=audio.get_format_from_width(BYTE_WIDTH),
+                channels=CHANNELS,
+                rate=RATE,
+                output=True,
+                start=True,
+                output_device_index=device,
+                frames_per_buffer=BUFFER_FRAMES,
+                stream_callback=self.callback)
     
-    # add the given file to the samples being played in the callback function
-    def play(self, filename):
-        # if it's already open, rewind it
-        sf = self.samp_files.get(filename)
-        if sf is not None:
-            sf.rewind()
-        # if it hasn't been opened, open it and add to queue
+    # add the given file to the samples being played in the callback function.
+    # If at is given, the sample starts on that frame instead of at the start of
+    # the next buffer; scheduled samples must be played in order of frame. source
+    # and step are only used to describe the event to the recorder
+    def play(self, filename, source: int = 0, step: int = -1, at: int = None):
+        # load it now if it hasn't been, so the callback doesn't have to
+        sf = self.load(filename)
+        if at is not None:
+            self.scheduled.append((at, sf, filename, source, step))
+        # the callback rewinds it at the start of the next buffer
         else:
-            sf = wave.open('samples/' + filename, 'rb')
+            self.queued_samples.append((sf, filename, source, step))
+
+    # load and trim the given file if it hasn't been already. Its entry in trims
+    # can be false to play the whole file, true to use the detected trim points,
+    # or a dict with any of "start" and "end" (in frames) to override the
+    # detected trim points and "threshold" to override self.threshold
+    def load(self, filename) -> Sample:
+        sf = self.samp_files.get(filename)
+        if sf is None:
+            trim = self.trims.get(filename, True)
+            if trim is True:
+                trim = dict()
+            elif trim is False:
+                trim = {'start': 0, 'end': float('inf')}
+            elif not isinstance(trim, dict):
+                raise Exception(f'Trim setting for {filename} must be true, false or an object')
+            else:
+                for key in ('start', 'end'):
+                    value = trim.get(key)
+                    # bool is an int, but true/false here is a mistake
+                    if value is not None and (not isinstance(value, int) or isinstance(value, bool)):
+                        raise Exception(f'Trim {key} for {filename} must be a whole number of frames')
+            sf = Sample('samples/' + filename, trim.get('start'), trim.get('end'),
+                    trim.get('threshold', self.threshold))
             self.samp_files[filename] = sf
-            self.queued_samples.add(sf)
+        return sf
+
+    # estimate the frame being output right now, by counting on from the start
+    # of the last buffer at the sample rate
+    def position(self) -> int:
+        frames, then = self.frames_time
+        return frames + int((time.time() - then) * RATE)
+
+    # drop all scheduled samples that haven't started yet
+    def cancel_scheduled(self):
+        with self.schedule_lock:
+            self.scheduled.clear()
     
     # Called by self.stream whenever more frames of audio output are needed.
     # It combines all samples currently being played by adding their waveform
@@ -66,22 +146,74 @@ class SampleStream:
     # This is done to ensure pyaudio will not close the stream, which we want to
     # remain open even if no audio is playing.
     def callback(self, in_data, frame_count, time_info, status):
-        # add any queued samples
-        self.samples.update(self.queued_samples)
-        self.queued_samples.clear()
+        data = self.render(frame_count)
+        if self.recorder is not None:
+            self.recorder.write_audio(data)
+        return (data, paContinue)
+
+    # mix the next frame_count frames of all playing samples into bytes
+    def render(self, frame_count: int) -> bytes:
+        self.frames_time = (self.frames, time.time())
+
+        # (re)start any queued samples. Only the callback takes from the queue,
+        # so a sample queued while we're here is started now or next buffer,
+        # and logged with the frame it actually starts on either way.
+        while self.queued_samples:
+            sf, filename, source, step = self.queued_samples.popleft()
+            if self.recorder is not None:
+                self.recorder.record(self.frames, source, step, filename,
+                        (sf.start, sf.end))
+            sf.rewind()
+            self.samples.add(sf)
 
-        # at most frame_count frames from each wave will be converted to ints
-        buffs: list[array] = []
         # final result
         result = array('h', b'\0' * frame_count * FRAME_WIDTH)
         # intermediate result
         temp = [0] * frame_count * CHANNELS
 
-        # read frame_count frames from each sample, convert to 16-bit ints
+        # mix up to each scheduled start inside this buffer, then (re)start the
+        # scheduled sample there. Late samples start at the beginning.
+        start = 0
+        end = self.frames + frame_count
+        while True:
+            with self.schedule_lock:
+                if not self.scheduled or self.scheduled[0][0] >= end:
+                    break
+                frame, sf, filename, source, step = self.scheduled.popleft()
+            split = max(frame - self.frames, 0)
+            if split > start:
+                self.mix(temp, start, split)
+                start = split
+            if self.recorder is not None:
+                self.recorder.record(self.frames + start, source, step, filename,
+                        (sf.start, sf.end))
+            sf.rewind()
+            self.samples.add(sf)
+        self.mix(temp, start, frame_count)
+        
+        # copy temp into result, clamp to signed 16-bit limits
+        for i in range(len(temp)):
+            if temp[i] > MAX:
+                result[i] = MAX
+            elif temp[i] < MIN:
+                result[i] = MIN
+            else:
+                result[i] = temp[i]
+        
+        self.frames += frame_count
+        # convert buffer back into bytes and return it
+        return result.tobytes()
+
+    # add frames start to stop (exclusive) of all playing samples into temp
+    def mix(self, temp: list[int], start: int, stop: int):
+        # at most stop - start frames from each sample will be converted to ints
+        buffs: list[array] = []
+
+        # read the frames from each sample, convert to 16-bit ints
         num_buffs = 0 # count number of buffers
-        for wave in self.samples:
+        for sample in self.samples:
             # read frames
-            wbytes = wave.readframes(frame_count)
+            wbytes = sample.readframes(stop - start)
 
             # if we've read all frames, don't include in buffs
             if len(wbytes) == 0:
@@ -92,19 +224,8 @@ class SampleStream:
             num_buffs += 1
 
         # add contents of all samples into temp
+        offset = start * CHANNELS
         for i in range(num_buffs):
             curr = buffs[i]
             for j in range(len(curr)):
-                temp[j] += curr[j]
-        
-        # copy temp into result, clamp to signed 16-bit limits
-        for i in range(len(temp)):
-            if temp[i] > MAX:
-                result[i] = MAX
-            elif temp[i] < MIN:
-                result[i] = MIN
-            else:
-                result[i] = temp[i]
-        
-        # convert buffer back into bytes and return it
-        return (result.tobytes(), paContinue)
+                temp[offset + j] += curr[j]
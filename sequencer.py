@@ -0,0 +1,83 @@
+'''
+sequencer.py
+
+Timing for the steps of the pattern. Step start times are kept as a table of
+frame offsets from the start of the pattern, so scheduling a step is a single
+lookup no matter how much swing or micro-timing is applied. The table is built
+once from the config when the program starts.
+
+Swing is the fraction of each pair of steps taken up by the first step: 0.5 is
+straight, 0.66 is roughly a triplet shuffle and 0.75 is the usual maximum. Per
+step offsets move individual steps by a fraction of a step. Steps are never
+moved past the steps after them.
+
+The pattern is always MAX_STEPS long. With the triplet resolutions that isn't a
+whole number of beats (16 eighth note triplets are 5 1/3 beats), so the pattern
+will not line up with the bars of a pattern playing on the MIDI device. The
+MIDI clock itself still follows the tempo, see beatclock.py.
+'''
+
+from samplestream import RATE
+
+MAX_STEPS = 16
+
+# steps per quarter note for each step resolution
+RESOLUTIONS: dict[str, int] = {
+    '8': 2,
+    '8t': 3,
+    '16': 4,
+    '16t': 6,
+    '32': 8
+}
+
+MIN_SWING = 0.5
+MAX_SWING = 0.75
+MAX_OFFSET = 0.5 # per step offsets are limited to half a step either way
+
+class StepTiming:
+
+    bpm: float
+    resolution: str
+    swing: float
+    # offset of each step, as a fraction of a step
+    offsets: list[float]
+
+    # frame each step starts on, relative to the start of the pattern
+    frames: list[int]
+    # length of the pattern in frames
+    loop_frames: int
+
+    def __init__(self, bpm: float, resolution: str = '16', swing: float = MIN_SWING,
+            offsets: list[float] = None):
+        if RESOLUTIONS.get(resolution) is None:
+            raise Exception(f'Unknown step resolution {resolution}, must be one of ' +
+                    ', '.join(RESOLUTIONS.keys()))
+        if not MIN_SWING <= swing <= MAX_SWING:
+            raise Exception(f'Swing must be between {MIN_SWING} and {MAX_SWING}')
+
+        self.bpm = bpm
+        self.resolution = resolution
+        self.swing = swing
+        # offsets beyond MAX_STEPS are ignored, missing ones are left at 0
+        self.offsets = [0.0] * MAX_STEPS
+        if offsets is not None:
+            for i in range(min(MAX_STEPS, len(offsets))):
+                self.offsets[i] = min(max(offsets[i], -MAX_OFFSET), MAX_OFFSET)
+        self.recompute()
+
+    # rebuild the table of step frames
+    def recompute(self):
+        step_len = RATE * 60 / self.bpm / RESOLUTIONS[self.resolution]
+        self.loop_frames = round(MAX_STEPS * step_len)
+        frames = [0] * MAX_STEPS
+        for i in range(MAX_STEPS):
+            pos = i + self.offsets[i]
+            # odd steps are pushed back by the swing
+            if i % 2 == 1:
+                pos += 2 * self.swing - 1
+            frames[i] = round(pos * step_len)
+        # steps are scheduled in order, so keep them in order, including the
+        # first step of the next run through the pattern
+        for i in range(1, MAX_STEPS):
+            frames[i] = min(max(frames[i], frames[i - 1]), self.loop_frames + frames[0])
+        self.frames = frames